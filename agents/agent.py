@@ -1,6 +1,6 @@
 import numpy
 import simpy
-from block import Block, sha256
+from block import Block
 from persistence import *
 from network import Socket, Link, Event
 
@@ -105,15 +105,15 @@ class Agent(object):
 
     def add_block(self, block):
         # Add the seed block to the known blocks
-        self.blocks[sha256(block)] = block
+        self.blocks[block.hash()] = block
         # Store the block in redis
-        r.zadd("miners:" + str(self.id) + ":blocks", block.height, sha256(block))
+        r.zadd("miners:" + str(self.id) + ":blocks", block.height, block.hash())
         # Announce block if chain_head isn't empty
         if self.chain_head == "*":
-            self.chain_head = sha256(block)
+            self.chain_head = block.hash()
         # If block height is greater than chain head, update chain head and announce new head
         if (block.height > self.blocks[self.chain_head].height):
-            self.chain_head = sha256(block)
+            self.chain_head = block.hash()
             self.announce_block(block)
 
     def wait_for_new_block(self):
@@ -154,7 +154,7 @@ class Agent(object):
             if valid == 1:
                 self.add_block(block)
             elif valid == 0:
-                #Logger.log(self.env.now, self.id, "NEED_DATA", sha256(block))
+                #Logger.log(self.env.now, self.id, "NEED_DATA", block.hash())
                 self.request_block(block.prev)
                 blocks_later.append(block)
         self.blocks_new = blocks_later
@@ -163,7 +163,7 @@ class Agent(object):
     def announce_block(self, block):
         if self.id == 8:
             print("Announce %s - %s" %(block, self.blocks[block].miner_id))
-        self.broadcast(Miner.HEAD_NEW, sha256(block))
+        self.broadcast(Miner.HEAD_NEW, block.hash())
 
     # Request a block to all links
     def request_block(self, block, to=None):
@@ -205,7 +205,7 @@ class Agent(object):
                 if data.payload not in self.blocks:
                     self.request_block(data.payload)
 
-            #print("Miner %d - receives block %d at %7.4f" %(self.id, sha256(data), self.env.now))
+            #print("Miner %d - receives block %d at %7.4f" %(self.id, data.hash(), self.env.now))
 
     def add_link(self, destination, delay):
         link = Link(self.id, destination, delay)
@@ -1,34 +1,70 @@
 import hashlib
-import pickle
+import struct
+from functools import lru_cache
 from persistence import *
 
 
-def sha256(data):
-    return hashlib.sha256(pickle.dumps(data)).hexdigest()
+# Block ids are only used as keys, a short blake2b digest is faster than sha256 and enough to tell blocks apart
+DIGEST_SIZE = 16
+# Fixed-width layout of the hashed fields: prev hash, height, time, miner id, size, valid. One contiguous buffer per block
+HEADER = struct.Struct('<%dsQdqdB' % DIGEST_SIZE)
+# Blocks waiting to be written to redis, and how many are sent per pipeline
+_pending_writes = []
+FLUSH_BATCH = 1000
+
+
+@lru_cache(maxsize=None)
+def blocks_mined_key(miner_id):
+    return "miners:" + str(miner_id) + ":blocks-mined"
 
 
 class Block:
-    def __init__(self, prev=None, height=None, time=None, miner_id=None, miner_name=None, size=None, valid=None):
-        self.prev = prev
+    # Fixed attribute layout, blocks are created by the thousand and have no need for a __dict__
+    __slots__ = ('prev_hash', 'height', 'time', 'miner_id', 'miner_name', 'size', 'valid', '_hash', 'validated_yet')
+
+    def __init__(self, prev_hash=None, height=None, time=None, miner_id=None, miner_name=None, size=None, valid=None, persist=True):
+        # Hash of the parent block, the parent itself is looked up in the miner's blocks
+        self.prev_hash = prev_hash
         self.height = height
         self.time = time
         self.miner_id = miner_id
         self.miner_name = miner_name
         self.size = size
         self.valid = valid
-        # When a block is created it is stored in redis
-        self.store()
+        # Cached block hash, computed on first use
+        self._hash = None
+        # When a block is created it is stored in redis, unless the simulation is not persisted
+        if persist: self.store()
         # helper for SPV miner
         self.validated_yet = False
 
+    def hash(self):
+        # Only the identifying fields are hashed so the digest never changes during the block's life
+        if self._hash is None:
+            # The seed block has no parent
+            prev = self.prev_hash or b'\0' * DIGEST_SIZE
+            self._hash = hashlib.blake2b(HEADER.pack(prev, self.height, self.time, self.miner_id, self.size, self.valid), digest_size=DIGEST_SIZE).digest()
+        return self._hash
+
     def store(self):
-        key = 'blocks:' + str(sha256(self))
-        # Store block in block list
-        r.zadd("blocks", self.height, sha256(self))
-        # Store the block info
-        r.hmset(key, {'prev': self.prev, 'height':self.height, 'time': self.time, 'size': self.size, 'valid': self.valid, 'miner': self.miner_id})
-        # Store reference block in the miner's blocks set
-        r.zadd("miners:" + str(self.miner_id) + ":blocks-mined", self.height, sha256(self))
+        # Blocks are buffered and written in bulk by Block.flush, keeping redis out of the simulation loop
+        _pending_writes.append((self.hash(), self.height, self.miner_id, {'prev': self.prev_hash, 'height':self.height, 'time': self.time, 'size': self.size, 'valid': self.valid, 'miner': self.miner_id}))
+
+    @staticmethod
+    def flush():
+        with r.pipeline(transaction=False) as pipe:
+            for i, (h, height, miner_id, info) in enumerate(_pending_writes, 1):
+                # Store block in block list
+                pipe.zadd("blocks", height, h)
+                # Store the block info
+                pipe.hmset(b'blocks:' + h, info)
+                # Store reference block in the miner's blocks set
+                pipe.zadd(blocks_mined_key(miner_id), height, h)
+                # Send in chunks to cap the size of the command buffer
+                if i % FLUSH_BATCH == 0:
+                    pipe.execute()
+            pipe.execute()
+        del _pending_writes[:]
 
     def __str__(self):
-        return "{}, {}, {}, {}, {}".format(self.height, self.time, self.miner_name, self.valid, str(sha256(self)))
\ No newline at end of file
+        return "{}, {}, {}, {}, {}".format(self.height, self.time, self.miner_name, self.valid, self.hash().hex())
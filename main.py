@@ -1,17 +1,27 @@
 import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import matplotlib.cm as cm
+# Plots are only saved to files, the non-interactive backend also works headless and in pool workers
+matplotlib.use('Agg')
 from persistence import *
 from block import Block
 from miner import Miner, HonestMiner, SPVMiner, AttackMiner
+import logging
 import moment
+import multiprocessing
+import os
+from functools import lru_cache
 import simpy
 import time
 import numpy
 
 
+# Flat Dirichlet parameters for a number of miners, built once per size. Every caller shares the array, so it is read-only
+@lru_cache(maxsize=None)
+def dirichlet_alpha(miners_number):
+    alpha = numpy.ones(miners_number)
+    alpha.setflags(write=False)
+    return alpha
+
+
 class Simulator:
 
     SIMULATION_ENDED = "SIMULATION_ENDED"
@@ -19,72 +29,100 @@ class Simulator:
     LOGGING_MODE = "debug"
 
     @staticmethod
-    def standard(miners_number=20, days=10):
-        # Convert simulation days to seconds
-        simulation_time = moment.get_seconds(days)
+    def standard(miners_number=20, days=10, hashrates=None, persist=True):
+        if persist and not Simulator.prepare_standard_db():
+            return -1
+        miners = Simulator.run_standard(miners_number, days, hashrates, persist)
+        Simulator.store_results(days, miners, persist)
+        return 0
+
+    @staticmethod
+    def standard_batch(miners_number=20, days=10, n_runs=100, persist=True):
+        # Same as standard repeated n_runs times, but the database is only set up once and every run is kept
+        if persist and not Simulator.prepare_standard_db():
+            return -1
+        # Draw the hashrates of every run in a single call
+        hashrates_all = numpy.random.dirichlet(dirichlet_alpha(miners_number), size=n_runs)
+        results = []
+        for k in range(n_runs):
+            miners = Simulator.run_standard(miners_number, days, hashrates_all[k], persist)
+            # The chain head height each miner ended with
+            results.append([miner._chain_head_height for miner in miners])
+            # Each run's heads are stored and announced before the next run starts
+            Simulator.store_results(days, miners, persist)
+        return results
+
+    @staticmethod
+    def prepare_standard_db():
         try:
-            print('here')
+            if Simulator.LOGGING_MODE == "debug": print('here')
             clear_db()
-            print('here')
+            if Simulator.LOGGING_MODE == "debug": print('here')
         except ConnectionError:
-            print('here')
-            return -1
+            if Simulator.LOGGING_MODE == "debug": print('here')
+            return False
         # Store in redis the simulation event names
         configure_event_names([Miner.BLOCK_REQUEST, Miner.BLOCK_RESPONSE, Miner.BLOCK_NEW, Miner.HEAD_NEW])
+        return True
+
+    @staticmethod
+    def run_standard(miners_number, days, hashrates=None, persist=True):
+        # Convert simulation days to seconds
+        simulation_time = moment.get_seconds(days)
         # Create simpy environment
         env = simpy.Environment()
-        store = simpy.FilterStore(env)
+        # Network mailboxes, one per miner
+        mailboxes = dict()
         # Create the seed block
-        seed_block = Block(None, 0, env.now, -1, 0, 1)
-        hashrates = numpy.random.dirichlet(numpy.ones(miners_number), size=1)
+        seed_block = Block(None, 0, env.now, -1, 'seed', 0, 1, persist=persist)
+        if hashrates is None:
+            hashrates = numpy.random.dirichlet(dirichlet_alpha(miners_number))
         # Create miners
         miners = []
-        # This dict is used to store the connections between miners, so they are not created twice
-        connections = dict()
         for i in range(0, miners_number):
-            miner = Miner(env, store, hashrates[0,i] * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block)
+            miner = Miner(env, mailboxes, hashrates[i] * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block, persist)
             miners.append(miner)
-            connections[miner] = dict()
-        # Randomly connect miners
-        for i, miner in enumerate(miners):
-            miner_connections = numpy.random.choice([True, False], miners_number)
-            for j, miner_connection in enumerate(miner_connections):
-                # Onlye create connection if miner is not self and connection does not already exist
-                if i != j and miner_connection == True and j not in connections[miner] and i not in connections[miners[j]]:
-                    # Store connection so its not created twice
-                    connections[miner][j] = True
-                    connections[miners[j]][i] = True
-                    Miner.connect(miner, miners[j])
+        # Randomly connect miners. Each miner picks its connections and a pair is linked if either side picked the other
+        choices = numpy.random.randint(0, 2, size=(miners_number, miners_number), dtype=bool)
+        # Keeping the upper triangle only creates every connection once and never connects a miner to itself
+        i_arr, j_arr = numpy.triu(choices | choices.T, k=1).nonzero()
+        # Plain ints index the miners list faster than numpy scalars
+        for i, j in zip(i_arr.tolist(), j_arr.tolist()):
+            Miner.connect(miners[i], miners[j])
         for miner in miners: miner.start()
         start = time.time()
         # Start simulation until limit. Time unit is seconds
         env.run(until=simulation_time)
         end = time.time()
-        print("Simulation took: %1.4f seconds" % (end - start))
+        if Simulator.LOGGING_MODE == "debug":
+            print("Simulation took: %1.4f seconds" % (end - start))
+            for miner in miners: print(miner.blocks[miner.chain_head].height, miner.chain_head.hex())
+        return miners
+
+    @staticmethod
+    def store_results(days, miners, persist=True):
+        # Nothing was buffered when the simulation is not persisted
+        if not persist:
+            return
+        # Write the blocks and miner data buffered during the simulation
+        Block.flush()
+        for miner in miners: miner.flush()
         # Store in redis simulation days
         store_days(days)
-        for miner in miners: print(miner.blocks[miner.chain_head].height, miner.chain_head)
-        # After simulation store every miner head, so their chain can be built again
-        for miner in miners: r.hset("miners:" + repr(miner.id), "head", miner.chain_head)
-        # Notify simulation ended
-        r.publish(Simulator.PUBSUB_CHANNEL, Simulator.SIMULATION_ENDED)
-        return 0
+        # One round-trip for all miner heads and the end notification. MULTI/EXEC makes subscribers see every head once notified
+        with r.pipeline(transaction=True) as pipe:
+            # After simulation store every miner head, so their chain can be built again
+            for miner in miners: pipe.hset(miner.key, "head", miner.chain_head)
+            # Notify simulation ended
+            pipe.publish(Simulator.PUBSUB_CHANNEL, Simulator.SIMULATION_ENDED)
+            pipe.execute()
 
     @staticmethod
-    def mixed_spv_attack(alpha=0.5, beta=0.5, days=10, target_confirmations=3, tSPV=0.5):
-        print("alpha - {}, beta = {}, days - {}, tgt - {}, tSPV - {}".format(
-            alpha,
-            beta,
-            days,
-            target_confirmations,
-            tSPV))
-        if (alpha + beta > 1.0): raise ValueError("Invalid power fractions")
-        # Convert simulation days to seconds
-        simulation_time = moment.get_seconds(days)
+    def prepare_mixed_db():
         try:
             clear_db()
         except ConnectionError:
-            return -1
+            return False
         # Store in redis the simulation event names
         configure_event_names([
             Miner.BLOCK_REQUEST,
@@ -94,60 +132,115 @@ class Simulator:
             AttackMiner.WIN,
             AttackMiner.LOSE
         ])
+        return True
+
+    @staticmethod
+    def mixed_spv_attack(alpha=0.5, beta=0.5, days=10, target_confirmations=3, tSPV=0.5, until_outcome=False, persist=True):
+        if Simulator.LOGGING_MODE == "debug":
+            print("alpha - {}, beta = {}, days - {}, tgt - {}, tSPV - {}".format(
+                alpha,
+                beta,
+                days,
+                target_confirmations,
+                tSPV))
+        if (alpha + beta > 1.0): raise ValueError("Invalid power fractions")
+        if persist and not Simulator.prepare_mixed_db():
+            return -1
+        attack_miner, miners = Simulator.run_mixed_spv_attack(alpha, beta, days, target_confirmations, tSPV, until_outcome, persist)
+        # for miner in miners: print(miner.name, miner.blocks[miner.chain_head].height, miner.chain_head)
+        Simulator.store_results(days, miners, persist)
+        return (attack_miner.wins, attack_miner.loses)
+
+    @staticmethod
+    def mixed_spv_attack_batch(alpha=0.5, beta=0.5, days=10, target_confirmations=3, tSPV=0.5, n_runs=1000, until_outcome=False, persist=True):
+        # Same as mixed_spv_attack repeated n_runs times, but the database is only set up once
+        if (alpha + beta > 1.0): raise ValueError("Invalid power fractions")
+        if persist and not Simulator.prepare_mixed_db():
+            return -1
+        results = []
+        for i in range(n_runs):
+            attack_miner, miners = Simulator.run_mixed_spv_attack(alpha, beta, days, target_confirmations, tSPV, until_outcome, persist)
+            results.append((attack_miner.wins, attack_miner.loses))
+            # Each run's heads are stored and announced before the next run starts
+            Simulator.store_results(days, miners, persist)
+        return results
+
+    @staticmethod
+    def run_mixed_spv_attack(alpha, beta, days, target_confirmations, tSPV, until_outcome=False, persist=True):
+        # Convert simulation days to seconds
+        simulation_time = moment.get_seconds(days)
         # Create simpy environment
         env = simpy.Environment()
-        store = simpy.FilterStore(env)
+        # Network mailboxes, one per miner
+        mailboxes = dict()
         # Create the seed block
-        seed_block = Block(None, 0, env.now, -1, 'seed', 0, 1)
+        seed_block = Block(None, 0, env.now, -1, 'seed', 0, 1, persist=persist)
         # Create miners
         miners = []
         # This dict is used to store the connections between miners, so they are not created twice
-        honest_miner = HonestMiner(env, store, beta * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block)
-        attack_miner = AttackMiner(env, store, alpha * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block, target_confirmations)
+        honest_miner = HonestMiner(env, mailboxes, beta * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block, persist)
+        attack_miner = AttackMiner(env, mailboxes, alpha * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block, target_confirmations, persist)
         miners = [honest_miner, attack_miner]
         other_agents = [honest_miner]
         Miner.connect(honest_miner, attack_miner)
         if alpha + beta < 1.0:
             # fraction of normal validation time to spend
-            spv_miner = SPVMiner(env, store, (1.0 - alpha - beta) * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block, tSPV)
+            spv_miner = SPVMiner(env, mailboxes, (1.0 - alpha - beta) * Miner.BLOCK_RATE, Miner.VERIFY_RATE, seed_block, tSPV, persist)
             miners.append(spv_miner)
             other_agents.append(spv_miner)
             Miner.connect(honest_miner, spv_miner)
             Miner.connect(attack_miner, spv_miner)
 
         attack_miner.set_agents(other_agents)
-        print('miner powers: [honest, attack, (spv)]: {}'.format(list(map(lambda x: x.hashrate, miners))))
+        if Simulator.LOGGING_MODE == "debug": print('miner powers: [honest, attack, (spv)]: {}'.format(list(map(lambda x: x.hashrate, miners))))
         for miner in miners: miner.start()
         start = time.time()
-        # Start simulation until limit. Time unit is seconds
-        env.run(until=simulation_time)
+        if until_outcome:
+            # Stop as soon as the attack is won or lost, the time limit is kept as an upper bound
+            env.run(until=env.timeout(simulation_time) | attack_miner.win | attack_miner.lose)
+        else:
+            # Start simulation until limit. Time unit is seconds
+            env.run(until=simulation_time)
         end = time.time()
         if Simulator.LOGGING_MODE == "debug":
             print("Simulation took: %1.4f seconds" % (end - start))
             print(attack_miner.wins, attack_miner.loses)
-        # Store in redis simulation days
-        store_days(days)
-        # for miner in miners: print(miner.name, miner.blocks[miner.chain_head].height, miner.chain_head)
-        # After simulation store every miner head, so their chain can be built again
-        for miner in miners: r.hset("miners:" + repr(miner.id), "head", miner.chain_head)
-        # Notify simulation ended
-        r.publish(Simulator.PUBSUB_CHANNEL, Simulator.SIMULATION_ENDED)
-        return (attack_miner.wins, attack_miner.loses)
+        return attack_miner, miners
+
+
+def run_one(args):
+    # Sweeps only use the win/lose counts, their runs never touch redis
+    seed, params = args
+    # Skip per-run logging. Set here because spawned workers re-import main with the default mode,
+    # miners log at debug level, which workers leave off
+    Simulator.LOGGING_MODE = "none"
+    # Seed from this run's own SeedSequence child so runs in different workers never share a random stream
+    numpy.random.seed(seed.generate_state(4))
+    return Simulator.mixed_spv_attack(*params, persist=False)
+
+
+def run_sweep(pool, runs):
+    # Runs are independent, spread them over the pool. Results keep the order of runs.
+    # The root seed comes from the global random state so numpy.random.seed still makes a sweep reproducible
+    seeds = numpy.random.SeedSequence(numpy.random.randint(2**63, dtype=numpy.int64)).spawn(len(runs))
+    return list(pool.imap(run_one, zip(seeds, runs)))
 
 
 def run_plain_simulation_with_varying_gamma(alpha=0.5, max_num_conf=21, days=10):
+    # pyplot is slow to import, only load it when plotting
+    import matplotlib.pyplot as plt
     plt.clf()
     fig, ax = plt.subplots()
-    for inx, beta in enumerate([0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]):
-        if alpha + beta > 1.0:
-            continue
-        # Simulator.standard(3, 1)
-        xs, ys = [], []
-        for i, elt in enumerate(range(1, max_num_conf)):
-            wins, loses = Simulator.mixed_spv_attack(round(alpha, 2), round(beta, 2), days * (elt + 1), elt)
-            xs.append(elt)
-            ys.append(wins * 1.0 / (loses + wins))
-        ax.plot(xs, ys, label='β = {}, γ = {}'.format(round(beta, 2), round(1 - alpha - beta, 2)))
+    # Every run is independent, spread them over all cores
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        for inx, beta in enumerate([0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]):
+            if alpha + beta > 1.0:
+                continue
+            # Simulator.standard(3, 1)
+            xs = list(range(1, max_num_conf))
+            results = run_sweep(pool, [(round(alpha, 2), round(beta, 2), days * (elt + 1), elt) for elt in xs])
+            ys = [wins * 1.0 / (loses + wins) for wins, loses in results]
+            ax.plot(xs, ys, label='β = {}, γ = {}'.format(round(beta, 2), round(1 - alpha - beta, 2)))
     ax.set_title('Success probability with α = {}'.format(alpha))
     ax.set_xlabel('Number of confirmations')
     ax.set_ylabel('Probabilitiy of success')
@@ -159,6 +252,8 @@ def run_plain_simulation_with_varying_gamma(alpha=0.5, max_num_conf=21, days=10)
 
 def run_mixed_sim_with_varying_attack_env(alpha, beta, gamma, max_num_conf=21, days=1):
     if alpha + beta + gamma > 1.0: raise ValueError("Invalid setup of power")
+    # pyplot is slow to import, only load it when plotting
+    import matplotlib.pyplot as plt
     plt.clf()
     fig, ax = plt.subplots()
     setup1 = [alpha, beta, gamma, 0.0]
@@ -175,19 +270,15 @@ def run_mixed_sim_with_varying_attack_env(alpha, beta, gamma, max_num_conf=21, d
         # setup5,
         # setup6
     ]
-    for inx, s in enumerate(setups):
-        xs, ys = [], []
-        for i, elt in enumerate(range(1, max_num_conf)):
-            wins, loses = Simulator.mixed_spv_attack(
-                alpha=s[0],
-                beta=s[1],
-                days=10 * days * (elt + 1),
-                target_confirmations=elt,
-                tSPV=s[3])
-            xs.append(elt)
-            ys.append(wins * 1.0 / (loses + wins))
-        print(xs, ys)
-        ax.plot(xs, ys, label='β = {}, γ = {}'.format(s[1], s[2]))
+    # Every run is independent, spread them over all cores
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        for inx, s in enumerate(setups):
+            xs = list(range(1, max_num_conf))
+            # Arguments are alpha, beta, days, target_confirmations and tSPV
+            results = run_sweep(pool, [(s[0], s[1], 10 * days * (elt + 1), elt, s[3]) for elt in xs])
+            ys = [wins * 1.0 / (loses + wins) for wins, loses in results]
+            print(xs, ys)
+            ax.plot(xs, ys, label='β = {}, γ = {}'.format(s[1], s[2]))
     ax.set_title('Success probability with varying agent environments')
     ax.set_xlabel('Number of confirmations')
     ax.set_ylabel('Probabilitiy of success')
@@ -198,6 +289,9 @@ def run_mixed_sim_with_varying_attack_env(alpha, beta, gamma, max_num_conf=21, d
     plt.savefig('artifacts/mixed-graph-{}-{}.png'.format(alpha, beta))    
 
 if __name__ == '__main__':
+    # Show the miners' debug log lines, other libraries stay at their default level
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('miner').setLevel(logging.DEBUG)
     print(Simulator.mixed_spv_attack(0.2, 0.5, 1, 6, 1.0))
     # run_plain_simulation_with_varying_gamma(0.2)
     # run_mixed_sim_with_varying_attack_env(0.2, 0.4, 0.3)
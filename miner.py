@@ -1,9 +1,17 @@
+import itertools
+import logging
 import numpy
 import simpy
-from block import Block, sha256
+from collections import deque
+from block import Block
 from persistence import *
 from network import Socket, Link, Event
 
+logger = logging.getLogger(__name__)
+
+# Miner ids for simulations that are not persisted, so they need no redis round-trip
+_miner_ids = itertools.count(1)
+
 
 class Miner(object):
 
@@ -18,34 +26,58 @@ class Miner(object):
     BLOCK_RATE = 1.0 / 600.0
     # A miner is able to verify 200KBytes per seconds
     VERIFY_RATE = 200*1024
+    # Block sizes are uniform up to 200KBytes
+    MAX_BLOCK_SIZE = 200*1024
+    # Block times and sizes are drawn this many at a time
+    RANDOM_BATCH = 4096
+    # Simulated seconds between sends of the queued redis writes
+    FLUSH_INTERVAL = 3600
 
-    LOGGING_MODE = "debug"
-    # LOGGING_MODE = 'none'
+    # Name of plain miners, subclasses set their own before calling Miner.__init__
+    name = 'mnr'
 
-    def __init__(self, env, store, hashrate, verifyrate, seed_block):
+    def __init__(self, env, mailboxes, hashrate, verifyrate, seed_block, persist=True):
         # Simulation environment
         self.env = env
-        # Get miner id from redis
+        # Write the miner, its blocks and its links to redis
+        self.persist = persist
+        # Get miner id, from redis when the simulation is persisted
         self.id = self.get_id()
+        # Redis keys of the miner, built once
+        self.key = "miners:" + str(self.id)
+        self.blocks_key = self.key + ":blocks"
+        # Redis writes are queued here and sent in one go by flush()
+        self.pipe = r.pipeline(transaction=False) if persist else None
         # print(self.id)
         # Socket
-        self.socket = Socket(env, store, self.id, self.name)
+        self.socket = Socket(env, mailboxes, self.id, self.name, persist)
         # Miner computing percentage of total network
         self.hashrate = hashrate
+        # Mean time between the miner's blocks
+        self._mean_time = 1.0 / hashrate
+        # Own generator for block times and sizes. It is seeded from the global random state so numpy.random.seed still makes a run reproducible
+        self.rng = numpy.random.default_rng(numpy.random.randint(2**63, dtype=numpy.int64))
+        # Pre-drawn block times and sizes with the position of the next one. Both are drawn on first use
+        self._times = self._sizes = None
+        self._time_i = self._size_i = Miner.RANDOM_BATCH
         # Miner block erification rate
         self.verifyrate = verifyrate
         # Store seed block
         self.seed_block = seed_block
-        # Pointer to the block chain head
-        self.chain_head = '*'
+        # Pointer to the block chain head, None until the seed block is added
+        self.chain_head = None
+        # Height of the chain head, kept in step with chain_head so it needs no block lookup
+        self._chain_head_height = -1
         # Hash with all the blocks the miner knows about
         self.blocks = dict()
-        # Array with blocks needed to be processed
-        self.blocks_new = []
-        # Create event to notify when a block is mined
-        self.block_mined = env.event()
-        # Create event to notify when a new block arrives
-        self.block_received = env.event()
+        # Height of every known block by hash, all verify_block needs of a parent
+        self._height_cache = dict()
+        # Queue with blocks needed to be processed
+        self.blocks_new = deque()
+        # Blocks mined or received, waiting to be picked up by wait_for_new_block
+        self.inbox = deque()
+        # Triggered when the inbox gets its first block, wait_for_new_block re-arms it for the next batch
+        self.inbox_ready = env.event()
         # Create event to notify when the mining process can continue
         self.continue_mining = env.event()
         self.mining = None
@@ -56,27 +88,42 @@ class Miner(object):
         self.total_blocks = 0
 
     def reset(self):
-        # Pointer to the block chain head
-        self.chain_head = '*'
+        # Pointer to the block chain head, None until the seed block is added
+        self.chain_head = None
+        # Height of the chain head, kept in step with chain_head so it needs no block lookup
+        self._chain_head_height = -1
         # Hash with all the blocks the miner knows about
         self.blocks = dict()
-        # Array with blocks needed to be processed
-        self.blocks_new = []
+        # Height of every known block by hash, all verify_block needs of a parent
+        self._height_cache = dict()
+        # Queue with blocks needed to be processed
+        self.blocks_new = deque()
+        self.inbox.clear()
         self.total_blocks = 0
         # Add the seed_block
         self.add_block(self.seed_block)
 
-    def __getattr__(self, name):
-        if Miner.LOGGING_MODE == "debug": print("Creating attribute %s."%name)
-        setattr(self, name, 'default')
-
     def get_id(self):
+        if not self.persist:
+            return next(_miner_ids)
         return get_id("miners")
 
     def store(self):
-        key = "miners:" + str(self.id)
-        r.hmset(key, {"hashrate": self.hashrate / Miner.BLOCK_RATE, "verifyrate": self.verifyrate})
-        r.sadd("miners", self.id)
+        if not self.persist:
+            return
+        self.pipe.hmset(self.key, {"hashrate": self.hashrate / Miner.BLOCK_RATE, "verifyrate": self.verifyrate})
+        self.pipe.sadd("miners", self.id)
+
+    def flush(self):
+        # Send the queued redis writes, the socket queues the network events
+        self.pipe.execute()
+        self.socket.flush()
+
+    def flush_periodically(self):
+        # Keep the queues small on long runs, the simulator sends what is left at the end
+        while True:
+            yield self.env.timeout(Miner.FLUSH_INTERVAL)
+            self.flush()
 
     def start(self):
         # Add the seed_block
@@ -87,129 +134,177 @@ class Miner(object):
         self.r_ev = self.env.process(self.receive_events())
         # Start mining and store the process so it can be interrupted
         self.mining = self.env.process(self.mine_block())
+        # Send the queued redis writes while the simulation runs
+        if self.persist: self.env.process(self.flush_periodically())
 
     def mine_block(self):
         # Indefinitely mine new blocks
         while True:
             try:
                 # Determine block size
-                block_size = 1024*200*numpy.random.random()
+                block_size = self.draw_block_size()
                 # Determine the time the block will be mined depending on the miner hashrate
-                time = numpy.random.exponential(1/self.hashrate, 1)[0]
+                time = self.draw_block_time()
                 # Wait for the block to be mined
                 yield self.env.timeout(time)
                 # Once the block is mined it needs to be added. An event is triggered
                 block = Block(
-                    prev=self.chain_head,
-                    height=self.blocks[self.chain_head].height + 1,
+                    prev_hash=self.chain_head,
+                    height=self._chain_head_height + 1,
                     time=self.env.now,
                     miner_id=self.id,
                     miner_name=self.name,
                     size=block_size,
-                    valid=1)
-                if Miner.LOGGING_MODE == "debug": print("{} mined a {} block at height: {}, time: {}, size: {}".format(self.name, 'valid' if block.valid else 'invalid', block.height, block.time, block.size))
+                    valid=1,
+                    persist=self.persist)
+                logger.debug("%s mined a %s block at height: %d, time: %s, size: %s", self.name, 'valid' if block.valid else 'invalid', block.height, block.time, block.size)
                 self.notify_new_block(block)
             except simpy.Interrupt as i:
                 # When the mining process is interrupted it cannot continue until it is told to continue
                 yield self.continue_mining
 
+    def draw_block_time(self):
+        # Time until the next block, exponentially distributed around the miner's mean block interval
+        if self._time_i == Miner.RANDOM_BATCH:
+            self._times = self.rng.exponential(self._mean_time, Miner.RANDOM_BATCH).tolist()
+            self._time_i = 0
+        self._time_i += 1
+        return self._times[self._time_i - 1]
+
+    def draw_block_size(self):
+        # Block size in bytes, uniform up to MAX_BLOCK_SIZE
+        if self._size_i == Miner.RANDOM_BATCH:
+            self._sizes = self.rng.uniform(0, Miner.MAX_BLOCK_SIZE, Miner.RANDOM_BATCH).tolist()
+            self._size_i = 0
+        self._size_i += 1
+        return self._sizes[self._size_i - 1]
+
     def notify_new_block(self, block):
         self.total_blocks += 1
-        if Miner.LOGGING_MODE == "debug": print("height  = {}, name = {}, valid = {}, time = {}, hash = {}".format(
-            block.height,
-            self.name,
-            (block.valid == 1),
-            round(self.env.now, 4),
-            sha256(block)))
-        self.block_mined.succeed(block)
-        # Create a new mining event
-        self.block_mined = self.env.event()
+        # The level check comes first so the block digest is only hex encoded when the line is emitted
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("height  = %d, name = %s, valid = %s, time = %.4f, hash = %s",
+                block.height,
+                self.name,
+                block.valid == 1,
+                self.env.now,
+                block.hash().hex())
+        self.push_inbox(block)
 
     def notify_received_block(self, block):
-        self.block_received.succeed(block)
-        # Create a new block received event
-        self.block_received = self.env.event()
+        self.push_inbox(block)
+
+    def push_inbox(self, block):
+        self.inbox.append(block)
+        # One wake-up per batch, later blocks join the batch already signalled
+        if not self.inbox_ready.triggered:
+            self.inbox_ready.succeed()
 
     def stop_mining(self):
-        if Miner.LOGGING_MODE == "debug": print('SSS | {} stopped mining'.format(self.name))
+        logger.debug('SSS | %s stopped mining', self.name)
         self.mining.interrupt()
 
     def keep_mining(self):
         self.continue_mining.succeed()
-        if Miner.LOGGING_MODE == "debug": print('CCC | {} continued mining'.format(self.name))
+        logger.debug('CCC | %s continued mining', self.name)
         self.continue_mining = self.env.event()
 
     def add_block(self, block):
-        # Add the seed block to the known blocks
-        self.blocks[sha256(block)] = block
+        # The block digest is memoized, it is read once and passed along
+        h = block.hash()
+        self._register_block(block, h)
+        self._maybe_update_head(block, h)
+
+    def _register_block(self, block, h):
+        # Add the block to the known blocks
+        self.blocks[h] = block
+        self._height_cache[h] = block.height
         # Store the block in redis
-        r.zadd("miners:" + str(self.id) + ":blocks", block.height, sha256(block))
-        # Announce block if chain_head isn't empty
-        if self.chain_head == "*":
-            self.chain_head = sha256(block)
+        if self.persist: self.pipe.zadd(self.blocks_key, block.height, h)
+        # The first block added, the seed, becomes the chain head without being announced
+        if self.chain_head is None:
+            self.chain_head = h
+            self._chain_head_height = block.height
+
+    def _maybe_update_head(self, block, h):
         # If block height is greater than chain head, update chain head and announce new head
-        if (block.height > self.blocks[self.chain_head].height):
-            self.chain_head = sha256(block)
+        if (block.height > self._chain_head_height):
+            self.chain_head = h
+            self._chain_head_height = block.height
             self.announce_block(block)
 
     def wait_for_new_block(self):
         while True:
-            try:
-                # Wait for a block to be mined or received
-                blocks = yield self.block_mined | self.block_received
-                # Interrupt the mining process so the block can be added
-                self.stop_mining()
-                #print("%d \tI stop mining" % self.id)
-                for event, block in blocks.items():
-                    # print("%s ||| Miner %s - mined block at %7.4f" %(self.name, block.miner_name, self.env.now))
-                    # Add the new block to the pending ones
-                    self.blocks_new.append(block)
-                    # Process new blocks
-                yield self.env.process(self.process_new_blocks())
-                # Keep mining
-                self.keep_mining()
-            except simpy.Interrupt as i:
-                # When the mining process is interrupted it cannot continue until it is told to continue
-                yield self.continue_mining
+            # Wait for a block to be mined or received. An event fired during the last batch or by a block of the
+            # same instant may still be queued ahead of continue_mining, yield a zero timeout instead so the mining
+            # process resumes before it can be interrupted again
+            yield self.env.timeout(0) if self.inbox_ready.triggered else self.inbox_ready
+            self.inbox_ready = self.env.event()
+            # A reset may have emptied the inbox in the meantime
+            if not self.inbox:
+                continue
+            # Interrupt the mining process so the block can be added
+            self.stop_mining()
+            #print("%d \tI stop mining" % self.id)
+            # Every block waiting in the inbox is processed in the same batch
+            for block in self.inbox:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("BBB | %s - received block at %s, height - %d, mined by %s, hash - %s, prev = %s", self.name, self.env.now, block.height, block.miner_name, block.hash().hex(), block.prev_hash.hex())
+                # Add the new block to the pending ones
+                self.blocks_new.append(block)
+            self.inbox.clear()
+            # Process new blocks
+            yield self.env.process(self.process_new_blocks())
+            self.check_chain_head()
+            # Keep mining
+            self.keep_mining()
+
+    def check_chain_head(self):
+        # Full miners validate every block before adding it, there is nothing left to check after a batch
+        pass
 
     def verify_block(self, block):
         # If block was mined by the miner but the previous block is not the chain head it will not be valid
-        if block.miner_id == self.id and block.prev != self.chain_head:
+        if block.miner_id == self.id and block.prev_hash != self.chain_head:
             return -1
         # If the previous block is not in miner blocks it is not possible to validate current block
-        if block.prev not in self.blocks:
+        parent_height = self._height_cache.get(block.prev_hash)
+        if parent_height is None:
             return 0
         # If block height isnt previous block + 1 it will not be valid
-        if block.height != self.blocks[block.prev].height + 1:
+        if block.height != parent_height + 1:
             return -1
         return 1
 
     def process_new_blocks(self):
-        blocks_later = []
-        # Validate every new block
-        for block in self.blocks_new:
-            if Miner.LOGGING_MODE == "debug": print('PPP | {} processing block at height {}'.format(self.name, block.height))
-            # Block validation takes some time
-            yield self.env.timeout(block.size / self.verifyrate)
+        # Block validation takes some time. Blocks of a batch are validated in parallel, so the largest one sets the delay
+        yield self.env.timeout(max((block.size for block in self.blocks_new), default=0) / self.verifyrate)
+        for _ in range(len(self.blocks_new)):
+            block = self.blocks_new.popleft()
+            logger.debug('PPP | %s processing block at height %d', self.name, block.height)
             valid = self.verify_block(block)
             if valid == 1:
                 self.add_block(block)
             elif valid == 0:
-                #Logger.log(self.env.now, self.id, "NEED_DATA", sha256(block))
-                self.request_block(block.prev)
-                blocks_later.append(block)
-        self.blocks_new = blocks_later
+                #Logger.log(self.env.now, self.id, "NEED_DATA", block.hash())
+                self.request_block(block.prev_hash)
+                # Keep the block queued until its parent arrives
+                self.blocks_new.append(block)
 
     # Announce new head when block is added to the chain
     def announce_block(self, block):
-        if self.id == 8:
-            if Miner.LOGGING_MODE == "debug": print("Announce %s - %s" %(block, self.blocks[block].miner_id))
+        if self.id == 8 and logger.isEnabledFor(logging.DEBUG):
+            # Honest miners announce the head hash, the others announce the block itself
+            announced = self.blocks[block] if block in self.blocks else block
+            logger.debug("Announce %s - %s", announced, announced.miner_id)
         # print("BCAST | {}".format(self.name))
         self.broadcast(Miner.HEAD_NEW, block)
 
     # Request a block to all links
     def request_block(self, block, to=None):
-        if Miner.LOGGING_MODE == "debug": print(self.env.now, self.name, "REQUEST", block, to)
+        if logger.isEnabledFor(logging.DEBUG):
+            # Heads announced as blocks are requested as they are, only raw digests need hex encoding
+            logger.debug("%s %s REQUEST %s %s", self.env.now, self.name, block.hex() if isinstance(block, bytes) else block, to)
         if to is None:
             self.broadcast(Miner.BLOCK_REQUEST, block)
         else:
@@ -232,32 +327,28 @@ class Miner(object):
 
     def receive_events(self):
         while True:
-            try:
-                # Wait for a network event
-                if len(self.socket.links) == 0:
-                    return
-                data = yield self.socket.receive(self.id)
-                if data.action == Miner.BLOCK_REQUEST:
-                    # Send block if we have it
-                    if data.payload in self.blocks:
-                        self.send_block(data.payload, data.origin)
-                elif data.action == Miner.BLOCK_RESPONSE:
-                    print("RRR | Received block {}".format(data.payload))
-                    self.notify_received_block(data.payload)
-                elif data.action == Miner.HEAD_NEW:
-                    # If we don't have the new head, we need to request it
-                    if data.payload not in self.blocks:
-                        self.request_block(data.payload)
-
-                #print("Miner %d - receives block %d at %7.4f" %(self.id, sha256(data), self.env.now))
-            except simpy.Interrupt as i:
-                # When the mining process is interrupted it cannot continue until it is told to continue
-                yield self.continue_mining
+            # Wait for a network event
+            if len(self.socket.links) == 0:
+                return
+            data = yield self.socket.receive(self.id)
+            if data.action == Miner.BLOCK_REQUEST:
+                # Send block if we have it
+                if data.payload in self.blocks:
+                    self.send_block(data.payload, data.origin)
+            elif data.action == Miner.BLOCK_RESPONSE:
+                logger.debug("RRR | Received block %s", data.payload)
+                self.notify_received_block(data.payload)
+            elif data.action == Miner.HEAD_NEW:
+                # If we don't have the new head, we need to request it
+                if data.payload not in self.blocks:
+                    self.request_block(data.payload)
+
+            #print("Miner %d - receives block %d at %7.4f" %(self.id, data.hash(), self.env.now))
 
     def add_link(self, destination, delay):
-        link = Link(self.id, destination, delay)
+        link = Link(self.id, destination, delay, self.persist)
         self.socket.add_link(link)
-        r.sadd("miners:" + str(self.id) + ":links", link.id)
+        if self.persist: self.pipe.sadd(self.key + ":links", link.id)
 
     @staticmethod
     def connect(miner, other_miner):
@@ -267,32 +358,27 @@ class Miner(object):
 
 class HonestMiner(Miner):
     # An Honest miner
-    def __init__(self, env, store, hashrate, verifyrate, seed_block):
+    def __init__(self, env, mailboxes, hashrate, verifyrate, seed_block, persist=True):
         self.name = 'hon'
-        super(HonestMiner, self).__init__( env, store, hashrate, verifyrate, seed_block)
+        super(HonestMiner, self).__init__( env, mailboxes, hashrate, verifyrate, seed_block, persist)
 
-    def add_block(self, block):
-        # Add the seed block to the known blocks
-        self.blocks[sha256(block)] = block
-        # Store the block in redis
-        r.zadd("miners:" + str(self.id) + ":blocks", block.height, sha256(block))
-        # Announce block if chain_head isn't empty
-        if self.chain_head == "*":
-            self.chain_head = sha256(block)
+    def _maybe_update_head(self, block, h):
         # If block height is greater than chain head and valid, update chain head and announce new head
-        if (block.height > self.blocks[self.chain_head].height) and block.valid:
-            self.chain_head = sha256(block)
+        if (block.height > self._chain_head_height) and block.valid:
+            self.chain_head = h
+            self._chain_head_height = block.height
             self.announce_block(self.chain_head)
 
 
 class SPVMiner(Miner):
     # An SPV miner
-    def __init__(self, env, store, hashrate, verifyrate, seed_block, val_frac):
-        self.chain_head_others = "*"
+    def __init__(self, env, mailboxes, hashrate, verifyrate, seed_block, val_frac, persist=True):
+        self.chain_head_others = None
+        self._chain_head_others_height = -1
         self.private_branch_len = 0
         self.val_frac = val_frac
         self.name = 'spv'
-        super(SPVMiner, self).__init__( env, store, hashrate, verifyrate, seed_block)
+        super(SPVMiner, self).__init__( env, mailboxes, hashrate, verifyrate, seed_block, persist)
 
     def start(self):
         # Add the seed_block
@@ -303,85 +389,74 @@ class SPVMiner(Miner):
         self.r_ev = self.env.process(self.receive_events())
         # Start mining and store the process so it can be interrupted
         self.mining = self.env.process(self.mine_block())
+        # Send the queued redis writes while the simulation runs
+        if self.persist: self.env.process(self.flush_periodically())
 
     def verify_block(self, block):
         # If the previous block is not in miner blocks it is not possible to validate current block
-        if block.prev not in self.blocks:
+        parent_height = self._height_cache.get(block.prev_hash)
+        if parent_height is None:
             return 0
         # If block height isnt previous block + 1 it will not be valid
-        if block.height != self.blocks[block.prev].height + 1:
+        if block.height != parent_height + 1:
             return -1
         return 1
 
     def process_new_blocks(self):
-        blocks_later = []
+        # Block validation is skipped for SPV miners, only a tiny delay is waited for, once per batch like the parallel validation of other miners
+        yield self.env.timeout(0.0000001)
         # Validate every new block
-        for block in self.blocks_new:
-            if Miner.LOGGING_MODE == "debug": print('PPP | {} processing block at height {}, hash - {}, prev - {}'.format(self.name, block.height, sha256(block), block.prev))
-            # Block validation is skipped for SPV miners
-            yield self.env.timeout(0.0000001)
+        for _ in range(len(self.blocks_new)):
+            block = self.blocks_new.popleft()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('PPP | %s processing block at height %d, hash - %s, prev - %s', self.name, block.height, block.hash().hex(), block.prev_hash.hex())
             valid = self.verify_block(block)
             # print(block, valid)
             if valid == 1:
                 self.add_block(block)
             elif valid == 0:
-                #Logger.log(self.env.now, self.id, "NEED_DATA", sha256(block))
-                self.request_block(block.prev)
-                blocks_later.append(block)
-        self.blocks_new = blocks_later
-
-    def add_block(self, block):
-        # Add the seed block to the known blocks
-        self.blocks[sha256(block)] = block
-        # Store the block in redis
-        r.zadd("miners:" + str(self.id) + ":blocks", block.height, sha256(block))
-        # Announce block if chain_head isn't empty
-        if self.chain_head == "*":
-            self.chain_head = sha256(block)
-            self.chain_head_others = sha256(block)
+                #Logger.log(self.env.now, self.id, "NEED_DATA", block.hash())
+                self.request_block(block.prev_hash)
+                # Keep the block queued until its parent arrives
+                self.blocks_new.append(block)
+
+    def _register_block(self, block, h):
+        # The first block also starts the tracked chain of the other miners
+        if self.chain_head is None:
+            self.chain_head_others = h
+            self._chain_head_others_height = block.height
+        super()._register_block(block, h)
+
+    def _maybe_update_head(self, block, h):
         # If block height is greater than chain head, update chain head and announce new head
-        if block.height > self.blocks[self.chain_head].height:
-            self.chain_head = sha256(block)
+        if block.height > self._chain_head_height:
+            self.chain_head = h
+            self._chain_head_height = block.height
             self.announce_block(block)
         # keep track of other chain
-        if block.height > self.blocks[self.chain_head_others].height and block.valid:
-            self.chain_head_others = sha256(block)
+        if block.height > self._chain_head_others_height and block.valid:
+            self.chain_head_others = h
+            self._chain_head_others_height = block.height
             self.announce_block(block)
 
-    def wait_for_new_block(self):
-        while True:
-            try:
-                # Wait for a block to be mined or received
-                blocks = yield self.block_mined | self.block_received
-                # Interrupt the mining process so the block can be added
-                self.stop_mining()
-                #print("%d \tI stop mining" % self.id)
-                for event, block in blocks.items():
-                    if Miner.LOGGING_MODE == "debug": print("BBB | {} - received block at {}, height - {}, mined by {}, hash - {}, prev = {}".format(self.name, self.env.now, block.height, block.miner_name, sha256(block), block.prev))
-                    # Add the new block to the pending ones
-                    self.blocks_new.append(block)
-                    # Process new blocks
-                yield self.env.process(self.process_new_blocks())
-                # Keep mining
-                if self.blocks[self.chain_head].height > 0:
-                    if not self.blocks[self.chain_head].validated_yet and self.val_frac > 0:
-                        self.env.process(self.validate_chain_head())
-
-                self.keep_mining()
-            except simpy.Interrupt as i:
-                # When the mining process is interrupted it cannot continue until it is told to continue
-                yield self.continue_mining
+    def check_chain_head(self):
+        # The new chain head was added unvalidated, validate it in the background while mining goes on
+        if self._chain_head_height > 0:
+            if not self.blocks[self.chain_head].validated_yet and self.val_frac > 0:
+                self.env.process(self.validate_chain_head())
 
     def validate_chain_head(self):
-        if Miner.LOGGING_MODE == "debug": print('VVV | validating chain head for {}'.format(self.val_frac * (self.blocks[self.chain_head].size / self.verifyrate)))
+        logger.debug('VVV | validating chain head for %s', self.val_frac * (self.blocks[self.chain_head].size / self.verifyrate))
         # Block validation takes some time
         yield self.env.timeout(self.val_frac * (self.blocks[self.chain_head].size / self.verifyrate))
         self.blocks[self.chain_head].validated_yet = True
         if not self.blocks[self.chain_head].valid:
-            if Miner.LOGGING_MODE == "debug": print("Switched chains after validating")
-            if Miner.LOGGING_MODE == "debug": print(self.chain_head, self.chain_head_others)
+            logger.debug("Switched chains after validating")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s %s", self.chain_head.hex(), self.chain_head_others.hex())
             self.chain_head = self.chain_head_others
-            if Miner.LOGGING_MODE == "debug": print('here after switching')
+            self._chain_head_height = self._chain_head_others_height
+            logger.debug('here after switching')
 
     def mine_block(self):
         # Indefinitely mine new blocks
@@ -390,7 +465,7 @@ class SPVMiner(Miner):
                 # SPV miner blocksize is 0 (empty)
                 block_size = 0
                 # Determine the time the block will be mined depending on the miner hashrate
-                time = numpy.random.exponential(1/self.hashrate, 1)[0]
+                time = self.draw_block_time()
                 # Wait for the block to be mined
                 yield self.env.timeout(time)
                 # If chain_head is valid then our block on top is valid, else invalid
@@ -400,14 +475,15 @@ class SPVMiner(Miner):
                     valid = 0
                 # create block
                 block = Block(
-                    prev=self.chain_head,
-                    height=self.blocks[self.chain_head].height + 1,
+                    prev_hash=self.chain_head,
+                    height=self._chain_head_height + 1,
                     time=self.env.now,
                     miner_id=self.id,
                     miner_name=self.name,
                     size=block_size,
-                    valid=valid)
-                if Miner.LOGGING_MODE == "debug": print("{} mined a {} block at height: {}, time: {}".format(self.name, 'valid' if block.valid else 'invalid', block.height, block.time))
+                    valid=valid,
+                    persist=self.persist)
+                logger.debug("%s mined a %s block at height: %d, time: %s", self.name, 'valid' if block.valid else 'invalid', block.height, block.time)
                 # Once the block is mined it needs to be added. An event is triggered
                 self.notify_new_block(block)
             except simpy.Interrupt as i:
@@ -420,9 +496,10 @@ class AttackMiner(Miner):
     LOSE = 6
 
     # A Malicious miner
-    def __init__(self, env, store, hashrate, verifyrate, seed_block, tgt_cfrms):
+    def __init__(self, env, mailboxes, hashrate, verifyrate, seed_block, tgt_cfrms, persist=True):
         self.name = 'att'
-        self.chain_head_others = "*"
+        self.chain_head_others = None
+        self._chain_head_others_height = -1
         # Number of confirmations needed
         self.tgt_cfrms = tgt_cfrms
         # Chain length in attacker's view
@@ -438,7 +515,7 @@ class AttackMiner(Miner):
         self.restart = False
         self.num_restarts = 0
         self.other_agents = []
-        super(AttackMiner, self).__init__(env, store, hashrate, verifyrate, seed_block)
+        super(AttackMiner, self).__init__(env, mailboxes, hashrate, verifyrate, seed_block, persist)
 
     def reset(self):
         self.invalid_len = 0
@@ -463,46 +540,63 @@ class AttackMiner(Miner):
                 agent.reset()
             self.reset()
 
-    def add_block(self, block):
-        # Add the seed block to the known blocks
-        self.blocks[sha256(block)] = block
-        # Store the block in redis
-        r.zadd("miners:" + str(self.id) + ":blocks", block.height, sha256(block))
-        # Announce block if chain_head isn't empty
-        if self.chain_head == "*":
-            self.chain_head = sha256(block)
-            self.chain_head_others = sha256(block)
-
-        if not block.valid:
-            if block.height > self.blocks[self.chain_head].height:
-                self.chain_head = sha256(block)
-                self.invalid_len += 1
+    def _register_block(self, block, h):
+        # The first block also starts the tracked chain of the other miners
+        if self.chain_head is None:
+            self.chain_head_others = h
+            self._chain_head_others_height = block.height
+        super()._register_block(block, h)
+
+    def _maybe_update_head(self, block, h):
+        # Only a block that beats the head of its own chain, the invalid one or the honest one, moves the attack
+        valid = bool(block.valid)
+        beats = block.height > (self._chain_head_others_height if valid else self._chain_head_height)
+        action = AttackMiner.TRANSITIONS.get((valid, beats))
+        if action is not None: action(self, block, h)
+        self.check_outcome()
+
+    def extend_invalid(self, block, h):
+        self.chain_head = h
+        self._chain_head_height = block.height
+        self.invalid_len += 1
+        self.announce_block(block)
+
+    def extend_honest(self, block, h):
+        height = block.height
+        self.chain_head_others = h
+        self._chain_head_others_height = height
+        # do we continue the attack or restart the "simulation"
+        if not self.restart:
+            if self.invalid_len > 0: self.honest_len += 1
+            # if attacker has already forked to invalid chain, we increment the counter
+            # or if the attacker has not forked, we restart on top of the honest network
+            if ((height > self._chain_head_height and self.invalid_len == 0) or self.honest_len == self.tgt_cfrms):
+                self.chain_head = h
+                self._chain_head_height = height
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('att - new chain head = %s, honest_lead = %d', h.hex(), self.honest_len)
                 self.announce_block(block)
         else:
-            if block.height > self.blocks[self.chain_head_others].height:
-                self.chain_head_others = sha256(block)
-                # do we continue the attack or restart the "simulation"
-                if not self.restart:
-                    if self.invalid_len > 0: self.honest_len += 1
-                    # if attacker has already forked to invalid chain, we increment the counter
-                    # or if the attacker has not forked, we restart on top of the honest network
-                    if ((block.height > self.blocks[self.chain_head].height and self.invalid_len == 0) or self.honest_len == self.tgt_cfrms):
-                        self.chain_head = sha256(block)
-                        if Miner.LOGGING_MODE == "debug": print('att - new chain head = {}, honest_lead = {}'.format(self.chain_head, self.honest_len))
-                        self.announce_block(block)
-                else:
-                    self.honest_len += 1
-        # if the attacker gets the final block for target confirmations here, reset values
-        if self.invalid_len == self.tgt_cfrms or self.honest_len == self.tgt_cfrms:
-            if self.invalid_len == self.tgt_cfrms:
-                self.wins += 1
-                self.win.succeed()
-                self.win = self.env.event()
-            else:
-                self.loses += 1
-                self.lose.succeed()
-                self.lose = self.env.event()
+            self.honest_len += 1
 
+    # Action for each (block is valid, block beats the head of its chain) pair, the other pairs leave the state as is
+    TRANSITIONS = {
+        (False, True): extend_invalid,
+        (True, True): extend_honest,
+    }
+
+    def check_outcome(self):
+        # if the attacker gets the final block for target confirmations here, reset values
+        if self.invalid_len == self.tgt_cfrms:
+            self.wins += 1
+            self.win.succeed()
+            self.win = self.env.event()
+            self.honest_len = 0
+            self.invalid_len = 0
+        elif self.honest_len == self.tgt_cfrms:
+            self.loses += 1
+            self.lose.succeed()
+            self.lose = self.env.event()
             self.honest_len = 0
             self.invalid_len = 0
 
@@ -510,21 +604,22 @@ class AttackMiner(Miner):
         # Indefinitely mine new blocks
         while True:
             try:
-                block_size = 1024*200*numpy.random.random()
+                block_size = self.draw_block_size()
                 # Determine the time the block will be mined depending on the miner hashrate
-                time = numpy.random.exponential(1/self.hashrate, 1)[0]
+                time = self.draw_block_time()
                 # Wait for the block to be mined
                 yield self.env.timeout(time)
                 # create invalid block
                 block = Block(
-                    prev=self.chain_head,
-                    height=self.blocks[self.chain_head].height + 1,
+                    prev_hash=self.chain_head,
+                    height=self._chain_head_height + 1,
                     time=self.env.now,
                     miner_id=self.id,
                     miner_name=self.name,
                     size=block_size,
-                    valid=0)
-                if Miner.LOGGING_MODE == "debug": print("{} mined a {} block at height: {}, time: {}, size: {}".format(self.name, 'valid' if block.valid else 'invalid', block.height, block.time, block.size))
+                    valid=0,
+                    persist=self.persist)
+                logger.debug("%s mined a %s block at height: %d, time: %s, size: %s", self.name, 'valid' if block.valid else 'invalid', block.height, block.time, block.size)
                 # Once the block is mined it needs to be added. An event is triggered
                 self.notify_new_block(block)
             except simpy.Interrupt as i:
@@ -1,9 +1,11 @@
 from datetime import timedelta
+from functools import lru_cache
 
 
 def days_passed(seconds):
     return timedelta(seconds=seconds).days
 
 
+@lru_cache(maxsize=None)
 def get_seconds(days):
     return days*24*3600
\ No newline at end of file
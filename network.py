@@ -1,16 +1,18 @@
 import moment
+import simpy
 from persistence import *
-from block import Block, sha256
+from block import Block
 
 
 class Link:
-    def __init__(self, origin, destination, delay):
+    def __init__(self, origin, destination, delay, persist=True):
         self.origin = origin
         self.destination = destination
-        self.id = self.get_id()
+        # Links that are not persisted never need a redis id
+        self.id = self.get_id() if persist else None
         self.delay = delay
         # Store link in database
-        self.store()
+        if persist: self.store()
 
     def get_id(self):
         return get_id("links")
@@ -25,10 +27,16 @@ class Link:
 
 
 class Socket:
-    def __init__(self, env, store, miner_id, miner_name):
+    def __init__(self, env, mailboxes, miner_id, miner_name, persist=True):
         self.miner_id = miner_id
         self.miner_name = miner_name
-        self.store = store
+        # Whether the events sent through this socket are stored in redis
+        self.persist = persist
+        # Event writes are queued here and sent by flush()
+        self.pipe = r.pipeline(transaction=False) if persist else None
+        self.mailboxes = mailboxes
+        # Each miner reads from its own queue, so receiving never scans other miners' events
+        mailboxes[miner_id] = simpy.Store(env)
         self.env = env
         self.links = dict()
 
@@ -36,48 +44,51 @@ class Socket:
         self.links[link.destination] = link
 
     def send(self, value, delay):
-        self.env.process(self.process_send(value, delay))
-
-    def process_send(self, value, delay):
-        yield self.env.timeout(delay)
-        self.store.put(value)
+        # Deliver once the link delay has passed. A timeout callback avoids starting a process per message
+        mailbox = self.mailboxes[value.destination]
+        self.env.timeout(delay).callbacks.append(lambda event: mailbox.put(value))
 
     # Send certain event to a specific miner
     def send_event(self, to, action, payload):
-        event = Event(to, self.miner_id, self.env.now, action, payload)
+        event = Event(to, self.miner_id, self.env.now, action, payload, self.persist, self.pipe)
         self.send(event, self.links[to].delay)
 
     # Broadcast an event to all links
     def broadcast(self, action, payload):
-        for to in self.links:
-            event = Event(to, self.miner_id, self.env.now, action, payload)
-            self.send(event, self.links[to].delay)
+        for to, link in self.links.items():
+            event = Event(to, self.miner_id, self.env.now, action, payload, self.persist, self.pipe)
+            self.send(event, link.delay)
 
     def receive(self, miner_id):
-        return self.store.get(filter=lambda event: event.destination == miner_id)
+        return self.mailboxes[miner_id].get()
+
+    def flush(self):
+        self.pipe.execute()
 
 class Event:
-    def __init__(self, destination, origin, time, action, payload):
+    def __init__(self, destination, origin, time, action, payload, persist=True, pipe=r):
         self.destination = destination
         self.origin = origin
         self.action = action
         self.payload = payload
         self.time = time
-        self.id = self.get_id()
-        self.store()
+        # Events that are not persisted never need a redis id
+        self.id = self.get_id() if persist else None
+        if persist: self.store(pipe)
 
     def get_id(self):
         return get_id("events")
 
-    def store(self):
+    def store(self, pipe=r):
+        # The writes go to redis directly or are queued on a pipeline
         key = "events:" + repr(self.id)
         # Store event
         data = {"destination": self.destination, "origin": self.origin, "action": self.action, "payload": self.payload, "time": self.time}
         if isinstance(self.payload, Block):
-            data['payload'] = sha256(self.payload)
-        r.hmset(key, data)
+            data['payload'] = self.payload.hash()
+        pipe.hmset(key, data)
         day = moment.days_passed(self.time)
-        r.zadd("events", self.time, self.id)
-        r.zadd("days:" + repr(day) + ":events:" + repr(self.action), self.time, self.id)
-        r.zadd("days:" + repr(day) + ":events", self.time, self.id)
-        r.zadd("miners:" + repr(self.origin) + ":events", self.time, self.id)
\ No newline at end of file
+        pipe.zadd("events", self.time, self.id)
+        pipe.zadd("days:" + repr(day) + ":events:" + repr(self.action), self.time, self.id)
+        pipe.zadd("days:" + repr(day) + ":events", self.time, self.id)
+        pipe.zadd("miners:" + repr(self.origin) + ":events", self.time, self.id)
\ No newline at end of file
@@ -0,0 +1,113 @@
+import unittest
+import numpy
+import simpy
+from block import Block
+from miner import Miner
+import main
+
+
+class CountingMiner(Miner):
+    # A miner that counts its batches and never mines a block of its own within a test
+
+    def __init__(self, env, seed_block):
+        self.batches = 0
+        super(CountingMiner, self).__init__(env, dict(), 1e-12, Miner.VERIFY_RATE, seed_block, persist=False)
+
+    def stop_mining(self):
+        self.batches += 1
+        super(CountingMiner, self).stop_mining()
+
+
+def child(parent, size, miner_id=99):
+    return Block(parent.hash(), parent.height + 1, 0, miner_id, 'mnr', size, 1, persist=False)
+
+
+class ProcessNewBlocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.env = simpy.Environment()
+        self.seed_block = Block(None, 0, 0, -1, 'seed', 0, 1, persist=False)
+        self.miner = CountingMiner(self.env, self.seed_block)
+
+    def test_batch_waits_for_its_largest_block(self):
+        self.miner.add_block(self.seed_block)
+        b1 = child(self.seed_block, 1000)
+        b2 = child(b1, 3000)
+        # A block whose parent is unknown stays queued for the next batch
+        orphan = Block(b'\1' * 16, 5, 0, 99, 'mnr', 2000, 1, persist=False)
+        self.miner.blocks_new.extend([b1, b2, orphan])
+        self.env.process(self.miner.process_new_blocks())
+        self.env.run()
+        self.assertEqual(self.env.now, 3000 / Miner.VERIFY_RATE)
+        self.assertEqual(self.miner.chain_head, b2.hash())
+        self.assertEqual(self.miner._chain_head_height, 2)
+        self.assertEqual(list(self.miner.blocks_new), [orphan])
+
+    def test_blocks_arriving_mid_batch_are_kept(self):
+        self.miner.start()
+        b1 = child(self.seed_block, 2048)
+        b2 = child(b1, 1024)
+        b3 = child(b2, 0)
+
+        def deliver():
+            yield self.env.timeout(1)
+            # Blocks of the same instant share a batch
+            self.miner.notify_received_block(b1)
+            self.miner.notify_received_block(b2)
+            # This one arrives while the batch is being validated
+            yield self.env.timeout(1024 / Miner.VERIFY_RATE)
+            self.miner.notify_received_block(b3)
+
+        self.env.process(deliver())
+        self.env.run(until=10)
+        self.assertEqual(self.miner.batches, 2)
+        self.assertEqual(self.miner.chain_head, b3.hash())
+        self.assertEqual(self.miner._chain_head_height, 3)
+        self.assertFalse(self.miner.blocks_new)
+        self.assertFalse(self.miner.inbox)
+
+    def test_block_at_the_end_of_a_batch(self):
+        self.miner.start()
+        b1 = child(self.seed_block, 2048)
+        b2 = child(b1, 0)
+
+        def deliver():
+            yield self.env.timeout(1)
+            self.miner.notify_received_block(b1)
+            # Let the batch start its validation timeout first, so b2 lands after the batch ends but before
+            # wait_for_new_block resumes. Mining must resume before the next batch interrupts it again
+            yield self.env.timeout(0)
+            yield self.env.timeout(2048 / Miner.VERIFY_RATE)
+            self.miner.notify_received_block(b2)
+
+        self.env.process(deliver())
+        self.env.run(until=10)
+        self.assertEqual(self.miner.batches, 2)
+        self.assertEqual(self.miner.chain_head, b2.hash())
+        self.assertEqual(self.miner._chain_head_height, 2)
+
+
+class SeededAttackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logging_mode = main.Simulator.LOGGING_MODE
+        main.Simulator.LOGGING_MODE = "none"
+
+    def tearDown(self):
+        main.Simulator.LOGGING_MODE = self.logging_mode
+
+    def test_seeded_run_is_reproducible(self):
+        numpy.random.seed(1)
+        attack_miner, miners = main.Simulator.run_mixed_spv_attack(0.4, 0.4, 1, 2, 0.5, persist=False)
+        honest_miner, _, spv_miner = miners
+        self.assertEqual((attack_miner.wins, attack_miner.loses), (27, 8))
+        self.assertEqual([miner._chain_head_height for miner in miners], [51, 51, 53])
+        self.assertEqual(attack_miner.chain_head, honest_miner.chain_head)
+        # Every block was processed by the end of the run
+        for miner in miners:
+            self.assertFalse(miner.blocks_new)
+            self.assertEqual(miner._chain_head_height, miner.blocks[miner.chain_head].height)
+
+
+if __name__ == '__main__':
+    unittest.main()